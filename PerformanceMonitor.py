@@ -1,18 +1,51 @@
+import os
+
+
 class PerformanceMonitor:
     """资源使用监控"""
     
+    def __init__(self):
+        # Linux下保持/proc/self/statm的文件描述符，每次采样只需一次pread；
+        # 其他平台复用同一个psutil.Process对象
+        self._statm_fd = None
+        self._page_size = None
+        self._proc = None
+        try:
+            self._statm_fd = os.open("/proc/self/statm", os.O_RDONLY)
+            self._page_size = os.sysconf("SC_PAGE_SIZE")
+        except (OSError, AttributeError, ValueError):
+            self.close()
+            import psutil
+            self._proc = psutil.Process()
+    
+    def _rss_mb(self) -> float:
+        """当前进程常驻内存（MB）"""
+        if self._statm_fd is not None:
+            # statm第二个字段为常驻内存页数
+            rss_pages = int(os.pread(self._statm_fd, 64, 0).split()[1])
+            return rss_pages * self._page_size / 1024 / 1024
+        return self._proc.memory_info().rss / 1024 / 1024
+    
+    def close(self):
+        """释放/proc/self/statm的文件描述符"""
+        if self._statm_fd is not None:
+            os.close(self._statm_fd)
+            self._statm_fd = None
+    
+    def __del__(self):
+        self.close()
+    
     def monitor_inference(self):
         """监控推理时间和内存使用"""
-        import psutil
         import time
         
         start_time = time.time()
-        start_memory = psutil.Process().memory_info().rss / 1024 / 1024  # MB
+        start_memory = self._rss_mb()  # MB
         
         # 执行推理...
         
         end_time = time.time()
-        end_memory = psutil.Process().memory_info().rss / 1024 / 1024
+        end_memory = self._rss_mb()
         
         return {
             "inference_time": end_time - start_time,
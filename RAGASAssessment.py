@@ -31,16 +31,22 @@ class RAGASAssessment:
         ground_truths = []
         references = []  # 添加这行
         
-        for case in test_cases:
+        # 批量嵌入与检索，只有SQL生成仍逐条调用LLM
+        retrievals = self.rag_system.retrieve_context_batch([case["question"] for case in test_cases])
+        
+        for case, (contexts, _, context_ids, question_vec) in zip(test_cases, retrievals):
             question = case["question"]
-            contexts, _ = self.rag_system.retrieve_context(question)
-            generated_sql = self.rag_system.generate_sql(question, contexts)
+            # 带上上下文ID与问题向量，已评估过的问题直接命中语义缓存且无需再次嵌入
+            generated_sql = self.rag_system.generate_sql(
+                question, contexts, context_ids=context_ids, question_vec=question_vec
+            )
             
             questions.append(question)
             answers.append(generated_sql)
             contexts_list.append(contexts)
             ground_truths.append([case["sql"]])
             references.append(case["sql"])
+        self.rag_system.flush_sem_cache()
         
         dataset_dict = {
             "question": questions,
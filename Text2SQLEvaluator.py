@@ -1,18 +1,131 @@
-from Text2SQLRAGSystem import Text2SQLRAGSystem
-from typing import Dict, Any, List
+from __future__ import annotations
+
+import asyncio
+import json
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Any, List, Tuple, TYPE_CHECKING
+import numpy as np
 from sqlalchemy import create_engine, text
 
+if TYPE_CHECKING:
+    from Text2SQLRAGSystem import Text2SQLRAGSystem
+
+# 预编译SQL标准化与关键元素提取用正则
+_RE_WS = re.compile(r'\s+')
+_RE_QUOTES = re.compile(r'["\'`]')
+_RE_COMMENT = re.compile(r'/\*.*?\*/')
+_RE_FROM = re.compile(r'FROM\s+(\w+)')
+_RE_SELECT = re.compile(r'SELECT\s+(.*?)\s+FROM')
+_RE_WHERE = re.compile(r'WHERE\s+(.*?)(?:\s+GROUP BY|\s+ORDER BY|$)')
+
+# 参与汇总的指标，顺序即指标矩阵的列顺序
+_METRIC_NAMES = (
+    "syntax_accuracy",
+    "execution_accuracy",
+    "exact_match",
+    "semantic_similarity",
+    "retrieval_quality"
+)
+
+
+def __getattr__(name: str):
+    """按需导出LightweightText2SQLEvaluator，只用Ollama评估路径时不加载torch/transformers"""
+    if name == "LightweightText2SQLEvaluator":
+        from lightweight_text2sql_evaluator import LightweightText2SQLEvaluator
+        return LightweightText2SQLEvaluator
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@lru_cache(maxsize=None)
+def _hashing_vectorizer():
+    """无状态哈希向量器，无需逐对fit；行向量L2归一化后余弦相似度即稀疏点积
+    
+    首次计算相似度时才导入sklearn。
+    """
+    from sklearn.feature_extraction.text import HashingVectorizer
+    return HashingVectorizer(n_features=2**14, alternate_sign=False, norm='l2')
+
+
+def _hashable_cell(cell):
+    """原样返回可哈希的单元格，list、dict等驱动返回的JSON/数组值转为键排序后的JSON串"""
+    try:
+        hash(cell)
+        return cell
+    except TypeError:
+        return json.dumps(cell, sort_keys=True, ensure_ascii=False, default=repr)
+
+
+@lru_cache(maxsize=1024)
+def _parse_sql_once(sql: str) -> Dict[str, Any]:
+    """对SQL只做一次大写与切分，结果供语法、精确匹配、语义相似度三项指标共用
+    
+    返回的字典被缓存共享，调用方不要修改。
+    """
+    upper = sql.upper()
+    
+    # 精确匹配用的标准化形式
+    norm = _RE_WS.sub(' ', upper).strip()
+    norm = _RE_QUOTES.sub('', norm)  # 移除引号
+    norm = _RE_COMMENT.sub('', norm)  # 移除注释
+    
+    # 提取表名、列名、条件等
+    tables = _RE_FROM.findall(upper)
+    columns = _RE_SELECT.findall(upper)
+    conditions = _RE_WHERE.findall(upper)
+    cols = [col.strip() for col in columns[0].split(',')] if columns else []
+    where = [cond.strip() for cond in conditions[0].split('AND')] if conditions else []
+    
+    # 结构检查复用同一份大写串，不再另做大写
+    select_pos = upper.find("SELECT")
+    from_pos = upper.find("FROM")
+    
+    return {
+        'norm': norm,
+        'elements': " ".join(tables + cols + where),
+        'has_select_from': select_pos >= 0 and from_pos >= 0,
+        'paren_balanced': upper.count('(') == upper.count(')'),
+        'select_before_from': select_pos <= from_pos
+    }
+
+
 class Text2SQLEvaluator:
-    def __init__(self, rag_system: Text2SQLRAGSystem):
+    def __init__(self, rag_system: Text2SQLRAGSystem, db_connection: str = None):
         self.rag_system = rag_system
         self.metrics_history = []
+        
+        # 评估器生命周期内复用同一个引擎及其连接池
+        self.db_connection = db_connection
+        self._engine = self._create_engine(db_connection) if db_connection else None
+    
+    @staticmethod
+    def _create_engine(db_connection: str):
+        return create_engine(db_connection, pool_pre_ping=True, pool_size=8)
+    
+    def _get_engine(self, db_connection: str = None):
+        """返回复用的引擎，仅在连接串变化时重建"""
+        if db_connection and db_connection != self.db_connection:
+            if self._engine is not None:
+                self._engine.dispose()
+            self.db_connection = db_connection
+            self._engine = self._create_engine(db_connection)
+        return self._engine
     
     def evaluate_single_example(self, question: str, ground_truth_sql: str, 
-                              db_connection: str = None) -> Dict[str, Any]:
-        """评估单个样例的多个指标:cite[9]"""
+                              db_connection: str = None, generated_sql: str = None,
+                              semantic_similarity: float = None,
+                              retrieval_scores: List[float] = None) -> Dict[str, Any]:
+        """评估单个样例的多个指标:cite[9]
+        
+        :param generated_sql: 已生成的SQL，不传则调用RAG系统生成
+        :param semantic_similarity: 已批量算好的语义相似度，不传则单独计算
+        :param retrieval_scores: 生成SQL时的检索得分，不传则重新检索
+        """
         
-        # 生成SQL
-        generated_sql = self.rag_system.generate_sql(question)
+        # 生成SQL，同时拿到生成时的检索得分，避免再次检索
+        if generated_sql is None:
+            generated_sql, _, retrieval_scores = self.rag_system.generate_sql_traced(question)
         
         metrics = {
             "question": question,
@@ -25,6 +138,7 @@ class Text2SQLEvaluator:
         metrics["syntax_accuracy"] = syntax_score
         
         # 2. 执行准确率（如果有数据库连接）
+        db_connection = db_connection or self.db_connection
         if db_connection and syntax_score > 0:
             exec_score = self._evaluate_execution_accuracy(generated_sql, ground_truth_sql, db_connection)
             metrics["execution_accuracy"] = exec_score
@@ -36,11 +150,12 @@ class Text2SQLEvaluator:
         metrics["exact_match"] = exact_match
         
         # 4. 语义相似度
-        semantic_similarity = self._evaluate_semantic_similarity(generated_sql, ground_truth_sql)
+        if semantic_similarity is None:
+            semantic_similarity = self._evaluate_semantic_similarity(generated_sql, ground_truth_sql)
         metrics["semantic_similarity"] = semantic_similarity
         
         # 5. 检索质量评估
-        retrieval_quality = self._evaluate_retrieval_quality(question, generated_sql)
+        retrieval_quality = self._evaluate_retrieval_quality(question, generated_sql, retrieval_scores)
         metrics["retrieval_quality"] = retrieval_quality
         
         return metrics
@@ -51,56 +166,51 @@ class Text2SQLEvaluator:
             return 0.0
         
         # 简单的SQL语法检查
-        basic_keywords = ["SELECT", "FROM", "WHERE", "JOIN", "GROUP BY", "ORDER BY"]
-        sql_upper = sql.upper()
+        parsed = _parse_sql_once(sql)
         
         # 检查基本结构
-        has_select_from = "SELECT" in sql_upper and "FROM" in sql_upper
-        if not has_select_from:
+        if not parsed['has_select_from']:
             return 0.0
         
         # 检查括号匹配
-        if sql_upper.count('(') != sql_upper.count(')'):
+        if not parsed['paren_balanced']:
             return 0.5
         
         # 检查基本关键字顺序
-        select_pos = sql_upper.find("SELECT")
-        from_pos = sql_upper.find("FROM")
-        if select_pos > from_pos:
+        if not parsed['select_before_from']:
             return 0.3
         
         return 1.0
     
     def _evaluate_execution_accuracy(self, generated_sql: str, ground_truth_sql: str, 
-                                   db_connection: str) -> float:
+                                   db_connection: str = None) -> float:
         """评估执行准确率:cite[4]"""
         try:
-            engine = create_engine(db_connection)
+            engine = self._get_engine(db_connection)
             
-            # 执行生成的SQL
+            # 同一连接内依次执行生成的SQL和标准答案SQL
             with engine.connect() as conn:
                 try:
-                    gen_result = conn.execute(text(generated_sql)).fetchall()
-                    gen_result = [dict(row) for row in gen_result]
+                    gen_rows = [tuple(row) for row in conn.execute(text(generated_sql))]
                 except Exception as e:
                     return 0.0
-            
-            # 执行标准答案SQL
-            with engine.connect() as conn:
+                
                 try:
-                    gt_result = conn.execute(text(ground_truth_sql)).fetchall()
-                    gt_result = [dict(row) for row in gt_result]
+                    gt_rows = [tuple(row) for row in conn.execute(text(ground_truth_sql))]
                 except Exception as e:
                     return 0.0
             
+            # 按行元组的多重集合比较，忽略结果顺序
+            gen_result = self._row_multiset(gen_rows)
+            gt_result = self._row_multiset(gt_rows)
+            
             # 比较结果
-            if len(gen_result) != len(gt_result):
+            if sum(gen_result.values()) != sum(gt_result.values()):
                 return 0.0
             
             # 简单比较（实际应用可能需要更复杂的比较逻辑）
-            for gen_row, gt_row in zip(gen_result, gt_result):
-                if gen_row != gt_row:
-                    return 0.5
+            if gen_result != gt_result:
+                return 0.5
             
             return 1.0
             
@@ -108,65 +218,60 @@ class Text2SQLEvaluator:
             print(f"执行评估错误: {e}")
             return 0.0
     
+    @staticmethod
+    def _row_multiset(rows: List[tuple]) -> Counter:
+        """结果行的多重集合；JSON、数组列等不可哈希的单元格转为规范JSON串后再计数"""
+        try:
+            return Counter(rows)
+        except TypeError:
+            return Counter(tuple(_hashable_cell(cell) for cell in row) for row in rows)
+    
     def _evaluate_exact_match(self, generated_sql: str, ground_truth_sql: str) -> float:
         """评估精确匹配率"""
-        import re
         
         # 标准化SQL进行比较
-        def normalize_sql(sql):
-            sql = re.sub(r'\s+', ' ', sql).upper().strip()
-            sql = re.sub(r'["\'`]', '', sql)  # 移除引号
-            sql = re.sub(r'/\*.*?\*/', '', sql)  # 移除注释
-            return sql
-        
-        norm_gen = normalize_sql(generated_sql)
-        norm_gt = normalize_sql(ground_truth_sql)
+        norm_gen = _parse_sql_once(generated_sql)['norm']
+        norm_gt = _parse_sql_once(ground_truth_sql)['norm']
         
         return 1.0 if norm_gen == norm_gt else 0.0
     
     def _evaluate_semantic_similarity(self, generated_sql: str, ground_truth_sql: str) -> float:
         """评估语义相似度"""
-        from sklearn.feature_extraction.text import TfidfVectorizer
-        from sklearn.metrics.pairwise import cosine_similarity
-        
-        # 提取SQL关键元素进行比较
-        def extract_sql_elements(sql):
-            elements = []
-            # 提取表名、列名、条件等
-            import re
-            tables = re.findall(r'FROM\s+(\w+)', sql.upper())
-            columns = re.findall(r'SELECT\s+(.*?)\s+FROM', sql.upper())
-            conditions = re.findall(r'WHERE\s+(.*?)(?:\s+GROUP BY|\s+ORDER BY|$)', sql.upper())
-            
-            elements.extend(tables)
-            if columns:
-                columns = columns[0].split(',')
-                elements.extend([col.strip() for col in columns])
-            if conditions:
-                conditions = conditions[0].split('AND')
-                elements.extend([cond.strip() for cond in conditions])
-            
-            return " ".join(elements)
         
-        gen_elements = extract_sql_elements(generated_sql)
-        gt_elements = extract_sql_elements(ground_truth_sql)
+        gen_elements = self._extract_sql_elements(generated_sql)
+        gt_elements = self._extract_sql_elements(ground_truth_sql)
         
         if not gen_elements or not gt_elements:
             return 0.0
         
-        # 计算余弦相似度
-        vectorizer = TfidfVectorizer()
-        try:
-            tfidf_matrix = vectorizer.fit_transform([gen_elements, gt_elements])
-            similarity = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:2])[0][0]
-            return similarity
-        except:
-            return 0.0
+        # 计算余弦相似度：哈希向量已L2归一化，点积即余弦
+        matrix = _hashing_vectorizer().transform([gen_elements, gt_elements])
+        return float(matrix[0].multiply(matrix[1]).sum())
+    
+    def _batch_semantic_similarity(self, generated_sqls: List[str], ground_truth_sqls: List[str]) -> List[float]:
+        """一次性向量化整个测试集，按行计算生成SQL与标准SQL的余弦相似度"""
+        n = len(generated_sqls)
+        if not n:
+            return []
+        
+        # 任一侧没有关键元素的样例行向量为零，相似度自然为0
+        matrix = _hashing_vectorizer().transform([self._extract_sql_elements(sql)
+                                for sql in list(generated_sqls) + list(ground_truth_sqls)])
+        return matrix[:n].multiply(matrix[n:]).sum(axis=1).A1.tolist()
+    
+    def _extract_sql_elements(self, sql: str) -> str:
+        """提取SQL关键元素（表名、列名、条件）用于相似度比较"""
+        return _parse_sql_once(sql)['elements']
     
-    def _evaluate_retrieval_quality(self, question: str, generated_sql: str) -> float:
-        """评估检索质量（简化版）"""
+    def _evaluate_retrieval_quality(self, question: str, generated_sql: str,
+                                    scores: List[float] = None) -> float:
+        """评估检索质量（简化版）
+        
+        :param scores: 生成SQL时已得到的检索得分，传入则不再重复检索
+        """
         # 这里可以扩展为更复杂的检索相关性评估
-        contexts, scores = self.rag_system.retrieve_context(question)
+        if scores is None:
+            _, scores = self.rag_system.retrieve_context(question)
         
         if not scores:
             return 0.0
@@ -174,37 +279,119 @@ class Text2SQLEvaluator:
         # 返回平均检索得分
         return sum(scores) / len(scores)
     
-    def comprehensive_evaluation(self, test_dataset: List[Dict], db_connection: str = None) -> Dict[str, Any]:
-        """全面评估在测试集上的表现"""
+    async def _generate_all_sql(self, questions: List[str], max_concurrency: int) -> List[Tuple[str, List[str], List[float]]]:
+        """并发调用Ollama生成SQL，用信号量限制同时在途的请求数
+        
+        逐例返回(sql, contexts, scores)。
+        """
+        import ollama
+        
+        client = ollama.AsyncClient()
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def generate(question: str) -> Tuple[str, List[str], List[float]]:
+            async with semaphore:
+                return await self.rag_system.generate_sql_traced_async(question, client=client)
+        
+        try:
+            return await asyncio.gather(*(generate(question) for question in questions))
+        finally:
+            await self.rag_system.close_async_client(client)
+    
+    def comprehensive_evaluation(self, test_dataset: List[Dict], db_connection: str = None,
+                                 max_concurrency: int = 4) -> Dict[str, Any]:
+        """全面评估在测试集上的表现
+        
+        :param max_concurrency: 同时发往Ollama的生成请求上限
+        """
+        traces = self._generate_dataset_sql(test_dataset, max_concurrency)
+        return self._build_evaluation_report(test_dataset, traces, db_connection)
+    
+    async def comprehensive_evaluation_async(self, test_dataset: List[Dict], db_connection: str = None,
+                                             max_concurrency: int = 4) -> Dict[str, Any]:
+        """comprehensive_evaluation的异步版本，供Jupyter等已运行事件循环的调用方并发生成"""
+        traces = await self._generate_dataset_sql_async(test_dataset, max_concurrency)
+        return self._build_evaluation_report(test_dataset, traces, db_connection)
+    
+    def comprehensive_evaluation_vectorized(self, test_dataset: List[Dict], db_connection: str = None,
+                                            max_concurrency: int = 4) -> Dict[str, Any]:
+        """同comprehensive_evaluation，但语义相似度在整个测试集上一次性向量化计算"""
+        traces = self._generate_dataset_sql(test_dataset, max_concurrency)
+        return self._build_vectorized_report(test_dataset, traces, db_connection)
+    
+    async def comprehensive_evaluation_vectorized_async(self, test_dataset: List[Dict], db_connection: str = None,
+                                                        max_concurrency: int = 4) -> Dict[str, Any]:
+        """comprehensive_evaluation_vectorized的异步版本"""
+        traces = await self._generate_dataset_sql_async(test_dataset, max_concurrency)
+        return self._build_vectorized_report(test_dataset, traces, db_connection)
+    
+    def _build_vectorized_report(self, test_dataset: List[Dict],
+                                 traces: List[Tuple[str, List[str], List[float]]],
+                                 db_connection: str = None) -> Dict[str, Any]:
+        similarities = self._batch_semantic_similarity(
+            [sql for sql, _, _ in traces],
+            [test_case["sql"] for test_case in test_dataset]
+        )
+        return self._build_evaluation_report(test_dataset, traces, db_connection, similarities)
+    
+    def _generate_dataset_sql(self, test_dataset: List[Dict],
+                              max_concurrency: int) -> List[Tuple[str, List[str], List[float]]]:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._generate_dataset_sql_async(test_dataset, max_concurrency))
+        
+        # 已处于运行中的事件循环（如Jupyter），无法嵌套asyncio.run，退回逐条同步生成
+        print("检测到运行中的事件循环，改为逐条生成SQL；如需并发请使用comprehensive_evaluation_async")
+        traces = [self.rag_system.generate_sql_traced(test_case["question"]) for test_case in test_dataset]
+        self.rag_system.flush_sem_cache()
+        return traces
+    
+    async def _generate_dataset_sql_async(self, test_dataset: List[Dict],
+                                          max_concurrency: int) -> List[Tuple[str, List[str], List[float]]]:
+        # 先并发生成全部SQL，重叠各用例的LLM等待时间
+        traces = await self._generate_all_sql(
+            [test_case["question"] for test_case in test_dataset],
+            max_concurrency
+        )
+        # 整批生成完成后语义缓存统一落盘一次
+        self.rag_system.flush_sem_cache()
+        return traces
+    
+    def _build_evaluation_report(self, test_dataset: List[Dict],
+                                 traces: List[Tuple[str, List[str], List[float]]],
+                                 db_connection: str = None,
+                                 semantic_similarities: List[float] = None) -> Dict[str, Any]:
+        """逐例计算指标并汇总为评估报告"""
         
         results = []
-        total_metrics = {
-            "syntax_accuracy": [],
-            "execution_accuracy": [],
-            "exact_match": [],
-            "semantic_similarity": [],
-            "retrieval_quality": []
-        }
+        # 每行一个用例、每列一个指标，缺失的指标记为NaN
+        metrics_arr = np.full((len(test_dataset), len(_METRIC_NAMES)), np.nan, dtype=np.float64)
         
-        for i, test_case in enumerate(test_dataset):
+        for i, (test_case, (generated_sql, _, scores)) in enumerate(zip(test_dataset, traces)):
             print(f"处理测试用例 {i+1}/{len(test_dataset)}")
             
             metrics = self.evaluate_single_example(
                 test_case["question"],
                 test_case["sql"],
-                db_connection
+                db_connection,
+                generated_sql=generated_sql,
+                semantic_similarity=semantic_similarities[i] if semantic_similarities is not None else None,
+                retrieval_scores=scores
             )
             
             results.append(metrics)
             
             # 汇总指标
-            for key in total_metrics.keys():
+            for j, key in enumerate(_METRIC_NAMES):
                 if key in metrics:
-                    total_metrics[key].append(metrics[key])
+                    metrics_arr[i, j] = metrics[key]
         
-        # 计算平均指标
-        avg_metrics = {f"avg_{key}": sum(values)/len(values) if values else 0.0 
-                      for key, values in total_metrics.items()}
+        # 计算平均指标，没有任何取值的指标记为0
+        counts = np.count_nonzero(~np.isnan(metrics_arr), axis=0)
+        sums = np.nansum(metrics_arr, axis=0)
+        averages = np.divide(sums, counts, out=np.zeros(len(_METRIC_NAMES)), where=counts > 0)
+        avg_metrics = {f"avg_{key}": value for key, value in zip(_METRIC_NAMES, averages.tolist())}
         
         evaluation_report = {
             "total_cases": len(test_dataset),
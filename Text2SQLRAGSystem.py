@@ -1,13 +1,150 @@
-import chromadb
-from chromadb.config import Settings
-import sqlalchemy as db
 from sqlalchemy import create_engine, text
 from typing import List, Dict, Any, Tuple
+from functools import lru_cache
+import asyncio
+import atexit
+import hashlib
+import itertools
 import json
+import os
+import re
+import shelve
+import tempfile
+import weakref
 import numpy as np
 
+# 预编译SQL清理用正则
+_RE_SQL_FENCE = re.compile(r'```sql\s*')
+_RE_FENCE_END = re.compile(r'\s*```')
+_RE_WS = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=None)
+def _load_embedding_function(model_name: str):
+    """同一进程内嵌入模型只加载一次，多次构造RAG系统时复用"""
+    from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
+    return SentenceTransformerEmbeddingFunction(
+        model_name=model_name,
+        device='cpu',
+        normalize_embeddings=True
+    )
+
+
+# 哈希词袋嵌入参数（FNV-1a 64位）
+_SIMPLE_EMBED_DIM = 512
+_FNV_OFFSET = np.uint64(14695981039346656037)
+_FNV_PRIME = np.uint64(1099511628211)
+
+
+def _hash_embed_py(buf: np.ndarray, offsets: np.ndarray, dim: int) -> np.ndarray:
+    """_hash_embed的纯Python实现，未安装numba时使用，结果与编译版本一致"""
+    offset, prime, mask = int(_FNV_OFFSET), int(_FNV_PRIME), 0xFFFFFFFFFFFFFFFF
+    out = np.zeros((offsets.shape[0] - 1, dim), dtype=np.float32)
+    for d in range(offsets.shape[0] - 1):
+        for token in buf[offsets[d]:offsets[d + 1]].tobytes().split():
+            h = offset
+            for c in token:
+                h = ((h ^ c) * prime) & mask
+            out[d, h % dim] += 1.0
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    np.divide(out, norms, out=out, where=norms > 0)
+    return out
+
+
+@lru_cache(maxsize=None)
+def _get_hash_embed():
+    """首次使用时才导入numba并编译内核，未安装numba时退回纯Python实现"""
+    try:
+        import numba
+    except ImportError:
+        return _hash_embed_py
+    
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _hash_embed(buf, offsets, dim):
+        """按ASCII空白切词，将各词的FNV-1a哈希累加到固定维度并L2归一化
+        
+        :param buf: 所有文档拼接后的UTF-8字节
+        :param offsets: 第d篇文档位于buf[offsets[d]:offsets[d+1]]
+        """
+        n_docs = offsets.shape[0] - 1
+        out = np.zeros((n_docs, dim), dtype=np.float32)
+        udim = np.uint64(dim)
+        for d in numba.prange(n_docs):
+            h = _FNV_OFFSET
+            in_token = False
+            for j in range(offsets[d], offsets[d + 1]):
+                c = buf[j]
+                if c == 32 or (c >= 9 and c <= 13):
+                    if in_token:
+                        out[d, np.int64(h % udim)] += 1.0
+                        h = _FNV_OFFSET
+                        in_token = False
+                else:
+                    h = (h ^ np.uint64(c)) * _FNV_PRIME
+                    in_token = True
+            if in_token:
+                out[d, np.int64(h % udim)] += 1.0
+            
+            norm = 0.0
+            for k in range(dim):
+                norm += out[d, k] * out[d, k]
+            if norm > 0.0:
+                norm = np.sqrt(norm)
+                for k in range(dim):
+                    out[d, k] /= norm
+        return out
+    return _hash_embed
+
+
+def _simple_embedding(texts: List[str]) -> List[List[float]]:
+    """哈希词袋嵌入作为备选：同一词总落在同一维度，不同文本的向量可直接比较"""
+    encoded = [text.lower().encode('utf-8') for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    buf = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    
+    return _get_hash_embed()(buf, offsets, _SIMPLE_EMBED_DIM).tolist()
+
+
+@lru_cache(maxsize=None)
+def _simple_embeddings_class():
+    """首次回退到哈希嵌入时才导入chromadb并定义EmbeddingFunction子类"""
+    from chromadb.api.types import Documents, EmbeddingFunction
+    
+    class _SimpleEmbeddings(EmbeddingFunction[Documents]):
+        """将哈希词袋嵌入包装为ChromaDB的EmbeddingFunction接口"""
+        
+        def __init__(self):
+            # 在构造线程（通常为主线程）上先跑一次内核：numba的TBB线程层若首次在工作线程
+            # （如异步生成的线程池）中启动，进程退出时会卡死
+            _simple_embedding([""])
+        
+        def __call__(self, input: Documents) -> List[List[float]]:
+            return _simple_embedding(input)
+        
+        @staticmethod
+        def name() -> str:
+            return f"simple-hash-{_SIMPLE_EMBED_DIM}"
+        
+        def default_space(self) -> str:
+            return "cosine"
+        
+        def get_config(self) -> Dict[str, Any]:
+            return {"dim": _SIMPLE_EMBED_DIM}
+        
+        @staticmethod
+        def build_from_config(config: Dict[str, Any]) -> "_SimpleEmbeddings":
+            return _SimpleEmbeddings()
+    
+    return _SimpleEmbeddings
+
+
 class Text2SQLRAGSystem:
-    def __init__(self, model_name: str = "qwen2.5-code:7b", db_connection: str = None):
+    def __init__(self, model_name: str = "qwen2.5-code:7b", db_connection: str = None,
+                 sem_cache_path: str = "./sem_cache", sem_cache_threshold: float = 0.97,
+                 sem_cache_min_jaccard: float = 0.6, emb_cache_path: str = "./emb_cache"):
+        import chromadb
+        
         self.model_name = model_name
         #self.chroma_client = chromadb.Client(Settings(
         #    chroma_db_impl="duckdb+parquet",
@@ -15,8 +152,27 @@ class Text2SQLRAGSystem:
         #))
         self.chroma_client = chromadb.PersistentClient(path="./chroma_db")
         
-        # 初始化向量集合
-        self.collection = self.chroma_client.get_or_create_collection(name="text2sql_knowledge")
+        # 初始化嵌入函数（使用本地模型）；入库与检索都由本地先嵌入，再按向量交给Chroma
+        self.embedding_model_name = "BAAI/bge-small-zh-v1.5"
+        self.embedding_function = self._get_embedding_function()
+        # 知识条目嵌入的磁盘缓存，重复训练时只嵌入新增或变化的行
+        self.emb_cache_path = emb_cache_path
+        
+        # 初始化向量集合；向量均已L2归一化，使用余弦距离使检索得分即余弦相似度。
+        # 不在集合上注册嵌入函数：新版Chroma会持久化嵌入函数名，BGE与哈希回退交替使用
+        # 同一./chroma_db时打开已有集合会报嵌入函数冲突
+        self.collection = self.chroma_client.get_or_create_collection(
+            name="text2sql_knowledge",
+            embedding_function=None,
+            metadata={"hnsw:space": "cosine"}
+        )
+        # 距离度量只在集合首次创建时生效，已有集合按其实际度量换算得分
+        self.distance_space = (self.collection.metadata or {}).get("hnsw:space", "l2")
+        if self.distance_space not in ("cosine", "ip", "l2"):
+            raise ValueError(f"不支持的向量距离度量: {self.distance_space}")
+        if self.distance_space != "cosine":
+            print(f"警告: 向量集合使用{self.distance_space}距离，检索得分按归一化向量换算为余弦相似度；"
+                  "如旧集合中的向量未归一化，请删除./chroma_db后重新训练")
         
         # 数据库连接
         if db_connection:
@@ -24,128 +180,183 @@ class Text2SQLRAGSystem:
         else:
             self.engine = None
             
-        # 初始化嵌入函数（使用本地模型）
-        self.embedding_function = self._get_embedding_function()
+        # 缓存最近的问题向量，同一问题重复检索时无需再次嵌入
+        self._embed_query = lru_cache(maxsize=4096)(self._embed_query_uncached)
+        
+        # 语义缓存：相似问题直接复用已生成的SQL，跳过LLM调用
+        self.sem_cache_path = sem_cache_path
+        self.sem_cache_threshold = sem_cache_threshold
+        # 命中还需检索上下文ID集合的Jaccard重合度达标，防止知识库变化后复用过期SQL
+        self.sem_cache_min_jaccard = sem_cache_min_jaccard
+        self._sem_cache = self._load_sem_cache()
+        # 新条目先留在内存，批量结束或进程退出时统一落盘
+        self._sem_cache_dirty = False
+        self_ref = weakref.ref(self)
+        atexit.register(lambda: self_ref() is not None and self_ref().flush_sem_cache())
     
     def _get_embedding_function(self):
         """使用本地嵌入模型"""
         try:
-            from langchain.embeddings import HuggingFaceEmbeddings
-            embeddings = HuggingFaceEmbeddings(
-                model_name="BAAI/bge-small-zh-v1.5",
-                model_kwargs={'device': 'cpu'}
-            )
-            return embeddings
+            return _load_embedding_function(self.embedding_model_name)
         except:
             # 回退到简单嵌入
-            return self._simple_embedding
-    
-    def _simple_embedding(self, texts: List[str]) -> List[List[float]]:
-        """简单的词频嵌入作为备选"""
-        from collections import defaultdict
-        import math
-        
-        embeddings = []
-        for text in texts:
-            words = text.lower().split()
-            word_count = defaultdict(int)
-            for word in words:
-                word_count[word] += 1
-            
-            # 简单的归一化向量
-            if word_count:
-                vector = list(word_count.values())
-                norm = math.sqrt(sum(x*x for x in vector))
-                normalized_vector = [x/norm for x in vector]
-                # 填充或截断为固定维度
-                if len(normalized_vector) < 512:
-                    normalized_vector.extend([0] * (512 - len(normalized_vector)))
-                else:
-                    normalized_vector = normalized_vector[:512]
-                embeddings.append(normalized_vector)
-            else:
-                embeddings.append([0] * 512)
-        
-        return embeddings
+            embedding_class = _simple_embeddings_class()
+            self.embedding_model_name = embedding_class.name()
+            return embedding_class()
+    
+    def _embed_query_uncached(self, question: str) -> Tuple[float, ...]:
+        # 转为Python float，Chroma不接受numpy标量
+        return tuple(np.asarray(self.embedding_function([question])[0], dtype=np.float32).tolist())
     
     def train_rag_model(self, ddl_files: List[str], doc_files: List[str], example_files: List[str]):
         """训练RAG模型：导入DDL、文档和示例:cite[4]"""
         
-        all_documents = []
-        metadatas = []
-        ids = []
-        
-        # 处理DDL文件
-        for ddl_file in ddl_files:
-            with open(ddl_file, 'r', encoding='utf-8') as f:
-                for i, line in enumerate(f):
-                    if line.strip():
-                        all_documents.append(line.strip())
-                        metadatas.append({"type": "ddl", "source": ddl_file})
-                        ids.append(f"ddl_{ddl_file}_{i}")
-        
-        # 处理文档文件
-        for doc_file in doc_files:
-            with open(doc_file, 'r', encoding='utf-8') as f:
-                for i, line in enumerate(f):
-                    if line.strip():
-                        all_documents.append(line.strip())
-                        metadatas.append({"type": "documentation", "source": doc_file})
-                        ids.append(f"doc_{doc_file}_{i}")
-        
-        # 处理示例文件
-        for example_file in example_files:
-            with open(example_file, 'r', encoding='utf-8') as f:
-                for i, line in enumerate(f):
-                    if line.strip():
-                        all_documents.append(line.strip())
-                        metadatas.append({"type": "example", "source": example_file})
-                        ids.append(f"ex_{example_file}_{i}")
+        # 流式读取DDL、文档和示例文件，按批嵌入入库，不整体载入内存
+        doc_stream = itertools.chain(
+            self._iter_docs(ddl_files, "ddl", "ddl"),
+            self._iter_docs(doc_files, "documentation", "doc"),
+            self._iter_docs(example_files, "example", "ex")
+        )
         
         # 批量添加到向量数据库
         batch_size = 100
-        for i in range(0, len(all_documents), batch_size):
-            batch_docs = all_documents[i:i+batch_size]
-            batch_metas = metadatas[i:i+batch_size]
-            batch_ids = ids[i:i+batch_size]
-            
-            # 生成嵌入
-            embeddings = self.embedding_function.embed_documents(batch_docs)
-            
-            self.collection.add(
-                embeddings=embeddings,
-                documents=batch_docs,
-                metadatas=batch_metas,
-                ids=batch_ids
-            )
+        total = 0
+        with shelve.open(self.emb_cache_path) as emb_cache:
+            while True:
+                batch = list(itertools.islice(doc_stream, batch_size))
+                if not batch:
+                    break
+                batch_docs, batch_metas, batch_ids = (list(col) for col in zip(*batch))
+                
+                # 生成嵌入（优先读取磁盘缓存）
+                embeddings = self._embed_documents_cached(batch_docs, emb_cache)
+                
+                self.collection.add(
+                    embeddings=embeddings,
+                    documents=batch_docs,
+                    metadatas=batch_metas,
+                    ids=batch_ids
+                )
+                total += len(batch_docs)
         
-        print(f"成功导入 {len(all_documents)} 条知识条目")
+        print(f"成功导入 {total} 条知识条目")
+    
+    def _embed_documents_cached(self, docs: List[str], emb_cache) -> List[List[float]]:
+        """按内容哈希查嵌入缓存，只对未命中的条目调用嵌入模型"""
+        # 键中带上模型名，换模型后旧向量自然失效
+        keys = [
+            hashlib.blake2b(f"{self.embedding_model_name}\0{doc}".encode('utf-8'), digest_size=16).hexdigest()
+            for doc in docs
+        ]
+        found = {key: emb_cache[key] for key in set(keys) if key in emb_cache}
+        
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        if missing:
+            new_embeddings = self.embedding_function([docs[i] for i in missing])
+            for i, embedding in zip(missing, new_embeddings):
+                # 转为Python float，Chroma不接受numpy标量
+                found[keys[i]] = emb_cache[keys[i]] = np.asarray(embedding, dtype=np.float32).tolist()
+        
+        return [found[key] for key in keys]
+    
+    @staticmethod
+    def _iter_docs(files: List[str], doc_type: str, id_prefix: str):
+        """逐行产出非空知识条目 (document, metadata, id)"""
+        for file in files:
+            with open(file, 'r', encoding='utf-8') as f:
+                for i, line in enumerate(f):
+                    line = line.strip()
+                    if line:
+                        yield line, {"type": doc_type, "source": file}, f"{id_prefix}_{file}_{i}"
     
     def retrieve_context(self, question: str, n_results: int = 5) -> Tuple[List[str], List[float]]:
         """检索与问题相关的上下文:cite[2]"""
+        contexts, scores, _, _ = self._retrieve(question, n_results)
+        return contexts, scores
+    
+    def _retrieve(self, question: str, n_results: int = 5) -> Tuple[List[str], List[float], List[str], np.ndarray]:
+        """检索上下文，同时返回命中的文档ID和归一化后的问题向量供语义缓存复用"""
         
-        # 生成问题嵌入
-        question_embedding = self.embedding_function.embed_query(question)
+        # 语义缓存需要问题向量，这里自行嵌入（带LRU缓存）后按向量检索
+        question_embedding = list(self._embed_query(question))
+        
+        return self._query_collection(n_results, [question_embedding])[0]
+    
+    def retrieve_context_batch(self, questions: List[str], n_results: int = 5
+                               ) -> List[Tuple[List[str], List[float], List[str], np.ndarray]]:
+        """批量检索：一次批量嵌入全部问题，再按向量一次查询
+        
+        逐条返回(contexts, scores, context_ids, 归一化问题向量)，后两项可传给generate_sql，
+        语义缓存校验时无需再次嵌入问题。
+        """
+        if not questions:
+            return []
+        
+        # 转为Python float，Chroma不接受numpy标量
+        question_embeddings = np.asarray(self.embedding_function(list(questions)), dtype=np.float32).tolist()
+        return self._query_collection(n_results, question_embeddings)
+    
+    def _query_collection(self, n_results: int, question_embeddings: List[List[float]]
+                          ) -> List[Tuple[List[str], List[float], List[str], np.ndarray]]:
+        """按问题向量检索相似内容，逐条返回(contexts, scores, context_ids, 归一化问题向量)"""
         
         # 检索相似内容
         results = self.collection.query(
-            query_embeddings=[question_embedding],
+            query_embeddings=question_embeddings,
             n_results=n_results,
             include=["documents", "distances", "metadatas"]
         )
         
-        contexts = results['documents'][0] if results['documents'] else []
-        scores = [1 - (distance / 10) for distance in results['distances'][0]] if results['distances'] else []
+        retrievals = []
+        for i in range(len(results['ids'])):
+            contexts = results['documents'][i] if results['documents'] else []
+            scores = [self._distance_to_score(distance) for distance in results['distances'][i]] if results['distances'] else []
+            context_ids = results['ids'][i]
+            question_vec = self._normalize(question_embeddings[i])
+            retrievals.append((contexts, scores, context_ids, question_vec))
         
-        return contexts, scores
+        return retrievals
     
-    def generate_sql(self, question: str, contexts: List[str] = None) -> str:
-        """使用Ollama本地模型生成SQL:cite[3]"""
+    def generate_sql(self, question: str, contexts: List[str] = None,
+                     context_ids: List[str] = None, question_vec: np.ndarray = None) -> str:
+        """使用Ollama本地模型生成SQL:cite[3]
+        
+        外部传入contexts时需同时给出对应的context_ids才会使用语义缓存。
+        
+        :param question_vec: retrieve_context_batch返回的问题向量，传入则语义缓存校验不再嵌入问题
+        """
+        sql, _, _ = self._generate_traced(question, contexts, context_ids, question_vec)
+        return sql
+    
+    def generate_sql_traced(self, question: str) -> Tuple[str, List[str], List[float]]:
+        """生成SQL，同时返回生成时使用的(contexts, scores)，调用方无需再次检索"""
+        return self._generate_traced(question)
+    
+    async def generate_sql_async(self, question: str, contexts: List[str] = None,
+                                 context_ids: List[str] = None, question_vec: np.ndarray = None,
+                                 client=None) -> str:
+        """generate_sql的异步版本，供并发生成使用
+        
+        :param client: 可复用的ollama.AsyncClient，不传则新建
+        """
+        sql, _, _ = await self._generate_traced_async(question, contexts, context_ids, question_vec, client)
+        return sql
+    
+    async def generate_sql_traced_async(self, question: str, client=None) -> Tuple[str, List[str], List[float]]:
+        """generate_sql_traced的异步版本"""
+        return await self._generate_traced_async(question, client=client)
+    
+    def _generate_traced(self, question: str, contexts: List[str] = None,
+                         context_ids: List[str] = None,
+                         question_vec: np.ndarray = None) -> Tuple[str, List[str], List[float]]:
         
         import ollama
         
-        if contexts is None:
-            contexts, _ = self.retrieve_context(question)
+        contexts, scores, context_ids, question_vec, cached_sql = self._prepare_generation(
+            question, contexts, context_ids, question_vec
+        )
+        if cached_sql is not None:
+            return cached_sql, contexts, scores
         
         # 构建prompt:cite[5]:cite[9]
         prompt = self._build_prompt(question, contexts)
@@ -154,21 +365,260 @@ class Text2SQLRAGSystem:
             response = ollama.generate(
                 model=self.model_name,
                 prompt=prompt,
-                options={
-                    'temperature': 0.1,
-                    'top_p': 0.9,
-                    'num_predict': 500
-                }
+                options=self._generation_options()
             )
+            sql = self._finish_generation(question, question_vec, context_ids, response['response'])
+            return sql, contexts, scores
             
-            sql = response['response'].strip()
-            # 清理SQL输出
-            sql = self._clean_sql_output(sql)
-            return sql
+        except Exception as e:
+            print(f"SQL生成错误: {e}")
+            return "", contexts, scores
+    
+    async def _generate_traced_async(self, question: str, contexts: List[str] = None,
+                                     context_ids: List[str] = None, question_vec: np.ndarray = None,
+                                     client=None) -> Tuple[str, List[str], List[float]]:
+        
+        import ollama
+        
+        # 嵌入与向量检索是同步的CPU/IO操作，放到线程池执行，不阻塞其他在途的Ollama请求
+        contexts, scores, context_ids, question_vec = await asyncio.get_running_loop().run_in_executor(
+            None, self._retrieve_for_generation, question, contexts, context_ids, question_vec
+        )
+        # 语义缓存的读写留在事件循环线程，避免与_finish_generation的写入并发
+        cached_sql = self._lookup_sem_cache(question_vec, context_ids) if question_vec is not None else None
+        if cached_sql is not None:
+            return cached_sql, contexts, scores
+        
+        # 构建prompt:cite[5]:cite[9]
+        prompt = self._build_prompt(question, contexts)
+        
+        own_client = client is None
+        if own_client:
+            client = ollama.AsyncClient()
+        
+        try:
+            response = await client.generate(
+                model=self.model_name,
+                prompt=prompt,
+                options=self._generation_options()
+            )
+            sql = self._finish_generation(question, question_vec, context_ids, response['response'])
+            return sql, contexts, scores
             
         except Exception as e:
             print(f"SQL生成错误: {e}")
-            return ""
+            return "", contexts, scores
+        finally:
+            if own_client:
+                await self.close_async_client(client)
+    
+    @staticmethod
+    async def close_async_client(client):
+        """关闭ollama.AsyncClient的连接池；ollama 0.3.x没有close方法，直接关闭底层httpx客户端"""
+        close = getattr(client, "close", None)
+        if close is not None:
+            await close()
+        else:
+            await client._client.aclose()
+    
+    def _prepare_generation(self, question: str, contexts: List[str], context_ids: List[str],
+                            question_vec: np.ndarray = None
+                            ) -> Tuple[List[str], List[float], List[str], np.ndarray, str]:
+        """必要时检索上下文并查询语义缓存
+        
+        返回(contexts, scores, context_ids, 问题向量, 命中的缓存SQL)；
+        contexts由调用方传入时scores为None。
+        """
+        
+        contexts, scores, context_ids, question_vec = self._retrieve_for_generation(
+            question, contexts, context_ids, question_vec
+        )
+        
+        # 语义缓存命中则直接返回，无需调用LLM
+        cached_sql = None
+        if question_vec is not None:
+            cached_sql = self._lookup_sem_cache(question_vec, context_ids)
+        
+        return contexts, scores, context_ids, question_vec, cached_sql
+    
+    def _retrieve_for_generation(self, question: str, contexts: List[str], context_ids: List[str],
+                                 question_vec: np.ndarray = None
+                                 ) -> Tuple[List[str], List[float], List[str], np.ndarray]:
+        """必要时检索上下文并嵌入问题，不读写语义缓存；问题向量为None表示跳过缓存"""
+        
+        scores = None
+        if contexts is None:
+            contexts, scores, context_ids, question_vec = self._retrieve(question)
+        elif context_ids is not None:
+            if question_vec is None:
+                question_vec = self._normalize(self._embed_query(question))
+        else:
+            # 缺少上下文ID无法做grounded校验，跳过缓存
+            question_vec = None
+        
+        return contexts, scores, context_ids, question_vec
+    
+    def _generation_options(self) -> Dict[str, Any]:
+        return {
+            'temperature': 0.1,
+            'top_p': 0.9,
+            'num_predict': 500
+        }
+    
+    def _finish_generation(self, question: str, question_vec: np.ndarray,
+                           context_ids: List[str], raw_response: str) -> str:
+        """清理模型输出并写入语义缓存"""
+        
+        sql = raw_response.strip()
+        # 清理SQL输出
+        sql = self._clean_sql_output(sql)
+        if sql and question_vec is not None:
+            self._add_to_sem_cache(question, question_vec, context_ids, sql)
+        return sql
+    
+    def _distance_to_score(self, distance: float) -> float:
+        """将Chroma返回的距离换算为余弦相似度（假定向量已L2归一化）"""
+        if self.distance_space == "l2":
+            # Chroma的l2为平方欧氏距离：|a-b|^2 = 2 - 2cos
+            return 1.0 - distance / 2.0
+        # 余弦距离 = 1 - 余弦相似度；ip距离 = 1 - 内积，归一化后二者相同
+        return 1.0 - distance
+    
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        """L2归一化，使余弦相似度退化为一次点积"""
+        vec = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+    
+    def _sem_cache_meta(self) -> Dict[str, str]:
+        """缓存SQL的来源：生成模型、嵌入模型以及提示词模板与生成参数的指纹
+        
+        任一项变化时旧缓存作废，避免评估报告中混入其他模型生成的SQL。
+        """
+        prompt_spec = json.dumps(
+            [self._build_prompt("{question}", ["{context}"]), self._generation_options()],
+            ensure_ascii=False, sort_keys=True
+        )
+        return {
+            'model_name': self.model_name,
+            'embedding_model_name': self.embedding_model_name,
+            'prompt_version': hashlib.blake2b(prompt_spec.encode('utf-8'), digest_size=8).hexdigest()
+        }
+    
+    def _empty_sem_cache(self) -> Dict[str, Any]:
+        return {'meta': self._sem_cache_meta(), 'vecs': np.empty((0, 0), dtype=np.float32),
+                'sqls': [], 'questions': [], 'ctx_ids': []}
+    
+    def _load_sem_cache(self) -> Dict[str, Any]:
+        """从磁盘加载语义缓存，来源与当前配置不一致时丢弃"""
+        vecs_file = os.path.join(self.sem_cache_path, "vecs.npy")
+        entries_file = os.path.join(self.sem_cache_path, "entries.json")
+        if os.path.exists(vecs_file) and os.path.exists(entries_file):
+            try:
+                with open(entries_file, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+                vecs = np.load(vecs_file).astype(np.float32)
+                if entries.get('meta') != self._sem_cache_meta():
+                    print("语义缓存与当前模型或提示词不匹配，已忽略")
+                elif vecs.shape[0] != len(entries['sqls']):
+                    print("语义缓存文件不完整，已忽略")
+                else:
+                    return {
+                        'meta': entries['meta'],
+                        'vecs': vecs,
+                        'sqls': entries['sqls'],
+                        'questions': entries['questions'],
+                        'ctx_ids': [frozenset(ids) for ids in entries['ctx_ids']]
+                    }
+            except Exception as e:
+                print(f"语义缓存加载失败: {e}")
+        return self._empty_sem_cache()
+    
+    def flush_sem_cache(self):
+        """将新增的语义缓存条目持久化到磁盘；批量生成结束后调用，进程退出时也会自动调用"""
+        if not self._sem_cache_dirty:
+            return
+        try:
+            self._save_sem_cache()
+            self._sem_cache_dirty = False
+        except Exception as e:
+            print(f"语义缓存保存失败: {e}")
+    
+    def _save_sem_cache(self):
+        """先写临时文件再重命名替换，中途失败不会留下损坏的缓存"""
+        os.makedirs(self.sem_cache_path, exist_ok=True)
+        self._atomic_write(os.path.join(self.sem_cache_path, "vecs.npy"),
+                           lambda f: np.save(f, self._sem_cache['vecs']))
+        entries = json.dumps({
+            'meta': self._sem_cache['meta'],
+            'sqls': self._sem_cache['sqls'],
+            'questions': self._sem_cache['questions'],
+            'ctx_ids': [sorted(ids) for ids in self._sem_cache['ctx_ids']]
+        }, ensure_ascii=False).encode('utf-8')
+        # 条目文件最后替换；两文件条数不一致时加载会丢弃缓存
+        self._atomic_write(os.path.join(self.sem_cache_path, "entries.json"),
+                           lambda f: f.write(entries))
+    
+    @staticmethod
+    def _atomic_write(path: str, write_fn):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_fn(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    
+    def _lookup_sem_cache(self, question_vec: np.ndarray, context_ids: List[str]) -> str:
+        """查找可安全复用的已缓存SQL，未命中返回None
+        
+        G1: 问题向量余弦相似度不低于sem_cache_threshold；
+        G2: 检索上下文ID集合的Jaccard重合度不低于sem_cache_min_jaccard。
+        """
+        self._check_sem_cache_meta()
+        vecs = self._sem_cache['vecs']
+        if not self._sem_cache['sqls'] or vecs.shape[1] != question_vec.shape[0]:
+            return None
+        
+        # 向量均已归一化，一次矩阵乘即得全部余弦相似度
+        sims = vecs @ question_vec
+        shortlist = np.flatnonzero(sims >= self.sem_cache_threshold)
+        if not shortlist.size:
+            return None
+        
+        ids = frozenset(context_ids)
+        for idx in shortlist[np.argsort(-sims[shortlist])]:
+            cached_ids = self._sem_cache['ctx_ids'][idx]
+            union = ids | cached_ids
+            if union and len(ids & cached_ids) / len(union) >= self.sem_cache_min_jaccard:
+                return self._sem_cache['sqls'][idx]
+        return None
+    
+    def _add_to_sem_cache(self, question: str, question_vec: np.ndarray,
+                          context_ids: List[str], sql: str):
+        """写入语义缓存，落盘由flush_sem_cache统一完成"""
+        self._check_sem_cache_meta()
+        vecs = self._sem_cache['vecs']
+        if vecs.size and vecs.shape[1] != question_vec.shape[0]:
+            # 嵌入模型维度变化，旧缓存失效
+            self._sem_cache = self._empty_sem_cache()
+            vecs = self._sem_cache['vecs']
+        
+        row = question_vec[np.newaxis, :]
+        self._sem_cache['vecs'] = np.vstack([vecs, row]) if vecs.size else row
+        self._sem_cache['sqls'].append(sql)
+        self._sem_cache['questions'].append(question)
+        self._sem_cache['ctx_ids'].append(frozenset(context_ids))
+        self._sem_cache_dirty = True
+    
+    def _check_sem_cache_meta(self):
+        """运行中切换了model_name等配置时清空内存中的缓存"""
+        meta = self._sem_cache_meta()
+        if self._sem_cache['meta'] != meta:
+            self._sem_cache = self._empty_sem_cache()
+            self._sem_cache_dirty = False
     
     def _build_prompt(self, question: str, contexts: List[str]) -> str:
         """构建优化的prompt模板:cite[5]"""
@@ -195,13 +645,12 @@ SQL查询："""
     
     def _clean_sql_output(self, sql: str) -> str:
         """清理SQL输出，移除markdown代码块等"""
-        import re
         
         # 移除```sql ... ```包装
-        sql = re.sub(r'```sql\s*', '', sql)
-        sql = re.sub(r'\s*```', '', sql)
+        sql = _RE_SQL_FENCE.sub('', sql)
+        sql = _RE_FENCE_END.sub('', sql)
         
         # 移除多余的空白字符
-        sql = re.sub(r'\s+', ' ', sql).strip()
+        sql = _RE_WS.sub(' ', sql).strip()
         
         return sql
\ No newline at end of file
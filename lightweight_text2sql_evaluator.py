@@ -1,15 +1,19 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
 import re
 from typing import Dict, List, Tuple
-import torch
 
 class LightweightText2SQLEvaluator:
-    def __init__(self, model_name: str = "microsoft/phi-2", device: str = "auto"):
+    def __init__(self, model_name: str = "microsoft/phi-2", device: str = "auto",
+                 load_in_8bit: bool = False):
         """
         初始化轻量级Text2SQL评估器
         :param model_name: 轻量级LLM模型名称
         :param device: 运行设备，"auto"自动选择GPU/CPU
+        :param load_in_8bit: 使用bitsandbytes做int8量化加载（仅GPU），显存约减半
         """
+        # torch/transformers导入开销大，延迟到真正构造评估器时
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+        
         # 自动选择设备
         if device == "auto":
             self.device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -18,18 +22,27 @@ class LightweightText2SQLEvaluator:
             
         # 加载模型和分词器
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # 批量生成时解码器模型需左侧填充，新生成的token才能对齐在末尾
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        
+        # GPU上优先BF16，注意力使用SDPA融合内核，加速短输出场景下占主导的prefill
+        if self.device == "cuda":
+            torch_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        else:
+            torch_dtype = torch.float32
+        model_kwargs = {}
+        if load_in_8bit:
+            from transformers import BitsAndBytesConfig
+            model_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+        
         self.model = AutoModelForCausalLM.from_pretrained(
             model_name,
-            torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-            device_map=self.device
-        )
-        
-        # 创建文本生成管道
-        self.pipeline = pipeline(
-            "text-generation",
-            model=self.model,
-            tokenizer=self.tokenizer,
-            device=0 if self.device == "cuda" else -1
+            torch_dtype=torch_dtype,
+            attn_implementation="sdpa",
+            device_map=self.device,
+            **model_kwargs
         )
         
         # 初始化提示词模板（针对轻量模型优化，更简洁明确）
@@ -64,19 +77,38 @@ SQL语句: {sql}
             return "不等价"
         return ""
 
+    def _generate_batch(self, prompts: List[str], batch_size: int = 8) -> List[str]:
+        """批量贪心生成，只返回各prompt新生成部分的文本"""
+        import torch
+        
+        completions = []
+        for i in range(0, len(prompts), batch_size):
+            inputs = self.tokenizer(
+                prompts[i:i+batch_size],
+                padding=True,
+                return_tensors="pt"
+            ).to(self.model.device)
+            
+            with torch.inference_mode():
+                outputs = self.model.generate(
+                    **inputs,
+                    max_new_tokens=5,
+                    do_sample=False,
+                    use_cache=True,
+                    pad_token_id=self.tokenizer.pad_token_id
+                )
+            
+            # 左侧填充后所有prompt等长，切掉输入部分即为新token
+            new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+            completions.extend(self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True))
+        
+        return completions
+
     def evaluate_grammar(self, sql: str) -> bool:
         """评估SQL语法正确性"""
         prompt = self.grammar_prompt.format(sql=sql)
         
-        outputs = self.pipeline(
-            prompt,
-            max_new_tokens=5,
-            temperature=0.0,
-            do_sample=False,
-            pad_token_id=self.tokenizer.eos_token_id
-        )
-        
-        result = self._clean_response(outputs[0]['generated_text'][len(prompt):])
+        result = self._clean_response(self._generate_batch([prompt])[0])
         return result == "正确"
 
     def evaluate_equivalence(self, question: str, sql1: str, sql2: str) -> bool:
@@ -87,15 +119,7 @@ SQL语句: {sql}
             sql2=sql2
         )
         
-        outputs = self.pipeline(
-            prompt,
-            max_new_tokens=5,
-            temperature=0.0,
-            do_sample=False,
-            pad_token_id=self.tokenizer.eos_token_id
-        )
-        
-        result = self._clean_response(outputs[0]['generated_text'][len(prompt):])
+        result = self._clean_response(self._generate_batch([prompt])[0])
         return result == "等价"
 
     def evaluate_correctness(self, question: str, sql: str, schema: str) -> bool:
@@ -106,15 +130,7 @@ SQL语句: {sql}
             sql=sql
         )
         
-        outputs = self.pipeline(
-            prompt,
-            max_new_tokens=5,
-            temperature=0.0,
-            do_sample=False,
-            pad_token_id=self.tokenizer.eos_token_id
-        )
-        
-        result = self._clean_response(outputs[0]['generated_text'][len(prompt):])
+        result = self._clean_response(self._generate_batch([prompt])[0])
         return result == "正确"
 
     def evaluate_single_case(
@@ -135,6 +151,9 @@ SQL语句: {sql}
             
         correct = self.evaluate_correctness(question, generated_sql, schema)
         
+        return self._combine_results(grammar_ok, equivalent, correct)
+
+    def _combine_results(self, grammar_ok: bool, equivalent, correct: bool) -> Dict:
         # 综合判断
         is_valid = grammar_ok and correct
         
@@ -147,19 +166,45 @@ SQL语句: {sql}
 
     def evaluate_batch(
         self,
-        test_cases: List[Dict]
+        test_cases: List[Dict],
+        batch_size: int = 8
     ) -> Tuple[float, List[Dict]]:
-        """批量评估测试集，返回准确率和详细结果"""
+        """批量评估测试集，返回准确率和详细结果
+        
+        :param batch_size: 每次送入模型的prompt数
+        """
         results = []
         valid_count = 0
         
-        for case in test_cases:
-            eval_result = self.evaluate_single_case(
+        # 按评估类型汇总prompt，整批送入模型生成
+        grammar_prompts = [self.grammar_prompt.format(sql=case["generated_sql"]) for case in test_cases]
+        correctness_prompts = [
+            self.correctness_prompt.format(
                 question=case["question"],
-                generated_sql=case["generated_sql"],
                 schema=case["schema"],
-                reference_sql=case.get("reference_sql", "")
+                sql=case["generated_sql"]
+            )
+            for case in test_cases
+        ]
+        # 无参考SQL时不评估等价性
+        ref_indices = [i for i, case in enumerate(test_cases) if case.get("reference_sql", "")]
+        equivalence_prompts = [
+            self.equivalence_prompt.format(
+                question=test_cases[i]["question"],
+                sql1=test_cases[i]["generated_sql"],
+                sql2=test_cases[i]["reference_sql"]
             )
+            for i in ref_indices
+        ]
+        
+        grammar = [self._clean_response(r) == "正确" for r in self._generate_batch(grammar_prompts, batch_size)]
+        correctness = [self._clean_response(r) == "正确" for r in self._generate_batch(correctness_prompts, batch_size)]
+        equivalence = [None] * len(test_cases)
+        for i, r in zip(ref_indices, self._generate_batch(equivalence_prompts, batch_size)):
+            equivalence[i] = self._clean_response(r) == "等价"
+        
+        for case, grammar_ok, equivalent, correct in zip(test_cases, grammar, equivalence, correctness):
+            eval_result = self._combine_results(grammar_ok, equivalent, correct)
             results.append({**case,** eval_result})
             if eval_result["is_valid"]:
                 valid_count += 1
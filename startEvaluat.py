@@ -1,6 +1,7 @@
 from Text2SQLRAGSystem import Text2SQLRAGSystem
 from Text2SQLEvaluator import Text2SQLEvaluator
-import json
+from pathlib import Path
+import orjson
 from RAGASAssessment import RAGASAssessment
 
 def main():
@@ -46,9 +47,11 @@ def main():
         "timestamp": "2025-09-26"
     }
     
-    # 保存报告
-    with open("evaluation_report.json", "w", encoding="utf-8") as f:
-        json.dump(final_report, f, ensure_ascii=False, indent=2)
+    # 保存报告（orjson直接输出UTF-8，中文不转义）
+    Path("evaluation_report.json").write_bytes(orjson.dumps(
+        final_report,
+        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    ))
     
     print("评估完成！报告已保存至 evaluation_report.json")
     